@@ -1,8 +1,10 @@
 import os
 import redis
-import json
+import datetime
 import dash_bootstrap_components as dbc
 
+from werkzeug.middleware.proxy_fix import ProxyFix
+
 from dash import (
     Dash,
     html,
@@ -19,13 +21,36 @@ from dash import (
 
 from utils.helpers import (
     random_workout_id,
-    create_workout_plan,
-    find_next_exercise,
+    cached_workout_plan,
+    locate_in_plan,
+    seek_segment,
+)
+from utils.storage import (
+    session_namespace,
+    save_workout as store_workout,
+    load_workout,
+    list_available_workouts,
 )
+from utils.revisions import record_revision, list_revisions, load_revision
+from utils.analytics import cached_library_report
+from utils.ratelimit import admit, Throttled
+from utils.assets import asset_url, register_asset_routes
 from utils.styles import DATATABLE_STYLES
 from utils.constants import START_COUNTDOWN, DEFAUlT_DURATION
 
-app = Dash(external_stylesheets=[dbc.themes.BOOTSTRAP])
+app = Dash(
+    external_stylesheets=[dbc.themes.BOOTSTRAP, asset_url("style.css")],
+    assets_ignore=r"^(style\.css|service-worker\.js)$",  # served by utils/assets.py
+    compress=True,  # gzip/brotli compress callback responses
+)
+register_asset_routes(app.server)
+
+# Number of reverse proxies in front of the app, so client addresses (used for rate
+# limiting) are read from X-Forwarded-For
+if os.environ.get("TRUSTED_PROXIES"):
+    app.server.wsgi_app = ProxyFix(
+        app.server.wsgi_app, x_for=int(os.environ["TRUSTED_PROXIES"])
+    )
 
 redis_instance = redis.StrictRedis.from_url(
     os.environ.get("REDIS_URL", "redis://127.0.0.1:6379")
@@ -76,6 +101,12 @@ app.layout = [
                                 n_clicks=0,
                                 class_name="button-style",
                             ),
+                            dbc.Button(
+                                "Library Stats",
+                                id="library-stats",
+                                n_clicks=0,
+                                class_name="button-style",
+                            ),
                         ]
                     ),
                     dbc.Button(
@@ -103,6 +134,12 @@ app.layout = [
                         color="danger",
                         dismissable=True,
                     ),
+                    dbc.Alert(
+                        id="select-workout-alert",
+                        is_open=False,
+                        color="warning",
+                        dismissable=True,
+                    ),
                 ],
             ),
             dbc.Modal(
@@ -116,6 +153,16 @@ app.layout = [
                                 id="saved-workouts",
                                 placeholder="Select a saved workout",
                             ),
+                            dcc.Dropdown(
+                                id="saved-workout-revisions",
+                                placeholder="Latest version",
+                            ),
+                            dbc.Alert(
+                                id="workout-revisions-alert",
+                                is_open=False,
+                                color="warning",
+                                dismissable=True,
+                            ),
                             html.Div(
                                 id="select-workout-div",
                                 children=[
@@ -132,16 +179,29 @@ app.layout = [
                 id="load-workout-modal",
                 size="sm",
             ),
+            dbc.Modal(
+                [
+                    dbc.ModalHeader(
+                        dbc.ModalTitle("Library Stats"), class_name="modal-header"
+                    ),
+                    dbc.ModalBody(id="library-report"),
+                ],
+                id="library-report-modal",
+                size="lg",
+            ),
             html.Div(
                 id="invisible-elements",
                 children=[
                     dcc.Store(
                         id="workout-plan",
                     ),
-                    html.Audio(
-                        id="audio-player",
-                        controls=False,
-                        src="/assets/bell.mp3",
+                    dcc.Store(id="user-id", storage_type="local"),
+                    dcc.Store(
+                        id="audio-urls",
+                        data={
+                            audio: asset_url("{}.mp3".format(audio))
+                            for audio in ("bell", "beep", "short_beep")
+                        },
                     ),
                     dcc.Store(id="trigger-audio", data="bell"),
                     html.Div(id="dummy-div", style={"display": "none"}),
@@ -171,6 +231,15 @@ app.layout = [
                                 id="bottom-display",
                                 children=[
                                     dbc.Progress(id="progress-bar", label="", value=0),
+                                    dcc.Slider(
+                                        id="workout-scrubber",
+                                        min=0,
+                                        max=START_COUNTDOWN,
+                                        step=1,
+                                        value=0,
+                                        marks=None,
+                                        tooltip={"placement": "bottom"},
+                                    ),
                                     html.Div(
                                         id="workout-mode-buttons",
                                         children=[
@@ -180,6 +249,12 @@ app.layout = [
                                                 n_clicks=0,
                                                 class_name="button-style",
                                             ),
+                                            dbc.Button(
+                                                "Previous",
+                                                id="previous-segment",
+                                                n_clicks=0,
+                                                class_name="button-style",
+                                            ),
                                             dbc.Button(
                                                 "Pause Workout",
                                                 id="pause-workout",
@@ -187,6 +262,12 @@ app.layout = [
                                                 disabled=True,
                                                 class_name="button-style",
                                             ),
+                                            dbc.Button(
+                                                "Next",
+                                                id="next-segment",
+                                                n_clicks=0,
+                                                class_name="button-style",
+                                            ),
                                             dbc.Button(
                                                 "Close Workout",
                                                 id="close-workout",
@@ -215,14 +296,24 @@ app.layout = [
 @callback(
     Output("workout-editor", "data"),
     Output("workout-name", "value"),
+    Output("select-workout-alert", "children"),
+    Output("select-workout-alert", "is_open"),
     Input("add-interval", "n_clicks"),
     Input("workout-editor", "data_previous"),
     Input("select-workout", "n_clicks"),
     State("workout-editor", "data"),
     State("saved-workouts", "value"),
+    State("saved-workout-revisions", "value"),
+    State("user-id", "data"),
 )
 def create_workout(
-    add, row_deleted, saved_workout_selected, current, saved_workout_value
+    add,
+    row_deleted,
+    saved_workout_selected,
+    current,
+    saved_workout_value,
+    revision,
+    user_id,
 ):
     """
     Callback controlling the editing of the create workout datatable
@@ -236,18 +327,35 @@ def create_workout(
     States:
         current (list): the workout data as it currently exists in the workout editor table
         saved_workout_value (str): the name of the selected saved workout
+        revision (int): the selected version of the saved workout (None for the latest)
+        user_id (str): the id of the user, used to find their saved workouts
 
     Outputs:
         list: the workout data in the workout editor table
         str: the name of the workout
+        str: the message displayed if the saved workout cannot be loaded right now
+        bool: whether or not the select-workout-alert is displayed
     """
     trigger = ctx.triggered_id  # callback context
 
     # Load workout from redis
     if trigger == "select-workout" and saved_workout_selected:
-        return json.loads(
-            redis_instance.hget("saved_workouts", saved_workout_value.encode("utf-8"))
-        ), saved_workout_value.replace("_", " ")
+        namespace = session_namespace(user_id)
+        try:
+            with admit(redis_instance, "load", user_id):
+                if revision:
+                    workout = load_revision(
+                        redis_instance, namespace, saved_workout_value, revision
+                    )
+                else:
+                    workout = load_workout(
+                        redis_instance, namespace, saved_workout_value
+                    )
+        except Throttled as e:
+            return no_update, no_update, str(e), True
+        if workout is None:  # workout no longer exists
+            return no_update, no_update, no_update, no_update
+        return workout, saved_workout_value.replace("_", " "), no_update, False
 
     # Update interval numbers when row is deleted
     if trigger == "workout-editor" and len(current) < len(row_deleted):
@@ -270,17 +378,19 @@ def create_workout(
                 "sub-intervals": 1,
             }
         )
-    return current, no_update
+    return current, no_update, no_update, no_update
 
 
 @callback(
     Output("load-workout-modal", "is_open"),
     Output("saved-workouts", "options"),
     Output("load-workout-alert", "is_open"),
+    Output("load-workout-alert", "children"),
     Input("load-workout", "n_clicks"),
     Input("select-workout", "n_clicks"),
+    State("user-id", "data"),
 )
-def load_saved_workouts(load_clicks, select_clicks):
+def load_saved_workouts(load_clicks, select_clicks, user_id):
     """
     Callback controlling the selection of saved workouts via the load-workout-modal
 
@@ -288,38 +398,45 @@ def load_saved_workouts(load_clicks, select_clicks):
         load_clicks (int): the number of times the "load workout" button has been clicked
         select_clicks (int): the number of timees the "select workout" button has been clicked
 
+    States:
+        user_id (str): the id of the user, used to find their saved workouts
+
     Outputs:
         bool: whether or not the load-workout-modal is open
         list: the dropdown options for the saved-workouts dropdown
         bool: whether or not the load-workout-alert is displayed
+        str: the message displayed in the load-workout-alert
     """
     trigger = ctx.triggered_id
 
     # Selecting a saved workout
     if trigger == "select-workout" and select_clicks:
-        return False, no_update, no_update
+        return False, no_update, no_update, no_update
 
     # Preventing select workout modal from opening on page load
     if not load_clicks:
-        return no_update, no_update, no_update
+        return no_update, no_update, no_update, no_update
 
     # Load saved workouts from redis - uses try/except to handle redis connection issues
     try:
-        saved_workouts = [
-            w.decode("utf-8") for w in redis_instance.hkeys("saved_workouts")
-        ]  # Decode saved names to string format
+        with admit(redis_instance, "load", user_id):
+            saved_workouts = list_available_workouts(
+                redis_instance, session_namespace(user_id)
+            )
+    except Throttled as e:
+        return False, no_update, True, str(e)
     except:
         saved_workouts = []
 
     # Return empty list if there are no saved workouts, or no connection to redis
     if not len(saved_workouts):
-        return False, no_update, True
+        return False, no_update, True, "No saved workouts!"
 
     # Format workout names to be displayed
     saved_workouts = [
         {"label": w.replace("_", " "), "value": w} for w in saved_workouts
     ]
-    return True, saved_workouts, no_update
+    return True, saved_workouts, no_update, no_update
 
 
 @callback(
@@ -329,8 +446,9 @@ def load_saved_workouts(load_clicks, select_clicks):
     Input("save-workout", "n_clicks"),
     State("workout-name", "value"),
     State("workout-editor", "data"),
+    State("user-id", "data"),
 )
-def save_workout(n_clicks, workout_name, data):
+def save_workout(n_clicks, workout_name, data, user_id):
     """
     Callback controlling the 'save workout' functionality
 
@@ -340,6 +458,7 @@ def save_workout(n_clicks, workout_name, data):
     States:
         workout_name (str): the name of the workout to be saved
         data (list): the workout data as it exists in the workout editor table
+        user_id (str): the id of the user the workout is saved for
 
     Outputs:
         str: the message to be displayed when a user attempts to save a workout
@@ -362,8 +481,23 @@ def save_workout(n_clicks, workout_name, data):
     )  # remove spaces from name to create workout_id
     try:
         # Display success message if data is successfully set in redis
-        redis_instance.hset("saved_workouts", workout_id, json.dumps(data))
+        namespace = session_namespace(user_id)
+        with admit(redis_instance, "save", user_id):
+            store_workout(redis_instance, namespace, workout_id, data)
+            try:
+                record_revision(redis_instance, namespace, workout_id, data)
+            except:
+                # The workout is saved, and saving again records the missing revision
+                return (
+                    "'{}' saved, but its version history could not be updated. "
+                    "Save again to retry".format(workout_name),
+                    True,
+                    "warning",
+                )
         return "'{}' successfully saved!".format(workout_name), True, "success"
+    except Throttled as e:
+        # Alert user if they are saving too often, or the server is busy
+        return str(e), True, "warning"
     except:
         # Alert user if redis cannot be accessed
         return (
@@ -373,6 +507,138 @@ def save_workout(n_clicks, workout_name, data):
         )
 
 
+@callback(
+    Output("library-report-modal", "is_open"),
+    Output("library-report", "children"),
+    Input("library-stats", "n_clicks"),
+    State("user-id", "data"),
+    prevent_initial_call=True,
+)
+def library_stats(n_clicks, user_id):
+    """
+    Callback which displays analytics across the user's saved workouts. The report is
+        cached, and is only rebuilt when the user's workouts have changed
+
+    Inputs:
+        n_clicks (int): the number of times the library-stats button has been clicked
+
+    States:
+        user_id (str): the id of the user, used to find their saved workouts
+
+    Outputs:
+        bool: whether or not the library-report-modal is open
+        list: the content of the library report
+    """
+    try:
+        with admit(redis_instance, "load", user_id):
+            report = cached_library_report(redis_instance, session_namespace(user_id))
+    except Throttled as e:
+        return True, str(e)
+    except:
+        return (
+            True,
+            "Cannot load library stats because redis connection cannot be established",
+        )
+
+    if not report["workouts"]:
+        return True, "No saved workouts!"
+
+    duration = report["duration"]
+    return True, [
+        html.P(
+            "{} saved workouts, {} intervals".format(
+                report["workouts"], report["intervals"]
+            )
+        ),
+        html.H5("Total duration"),
+        html.P(
+            "Median {:.1f} min, mean {:.1f} min, 90th percentile {:.1f} min".format(
+                duration["median"] / 60, duration["mean"] / 60, duration["p90"] / 60
+            )
+        ),
+        dbc.Table(
+            [html.Tr([html.Th("Minutes"), html.Th("Workouts")])]
+            + [
+                html.Tr(
+                    [html.Td("{:.1f} - {:.1f}".format(low, high)), html.Td(count)]
+                )
+                for low, high, count in duration["histogram"]
+            ],
+            size="sm",
+        ),
+        html.H5("Density"),
+        html.P(
+            "{:.1f} intervals per workout, {:.2f} sub-intervals per minute".format(
+                report["intervals_per_workout"],
+                report["sub_intervals_per_minute"]["mean"],
+            )
+        ),
+        html.H5("Most common exercises"),
+        dbc.Table(
+            [html.Tr([html.Th("Exercise"), html.Th("Intervals")])]
+            + [
+                html.Tr([html.Td(exercise), html.Td(count)])
+                for exercise, count in report["top_exercises"]
+            ],
+            size="sm",
+        ),
+    ]
+
+
+@callback(
+    Output("saved-workout-revisions", "options"),
+    Output("saved-workout-revisions", "value"),
+    Output("workout-revisions-alert", "children"),
+    Output("workout-revisions-alert", "is_open"),
+    Input("saved-workouts", "value"),
+    State("user-id", "data"),
+    prevent_initial_call=True,
+)
+def load_workout_revisions(selection, user_id):
+    """
+    Callback which lists the saved versions of the selected saved workout, so that an
+        earlier version can be loaded (e.g. to undo a save)
+
+    Inputs:
+        selection (str): the name of the saved workout (according to redis)
+
+    States:
+        user_id (str): the id of the user, used to find their saved workouts
+
+    Outputs:
+        list: the dropdown options for the saved-workout-revisions dropdown
+        int: the selected version, reset to the latest version
+        str: the message displayed if the versions cannot be listed right now
+        bool: whether or not the workout-revisions-alert is displayed
+    """
+    if not selection:
+        return [], None, no_update, False
+
+    try:
+        with admit(redis_instance, "load", user_id):
+            revisions = list_revisions(
+                redis_instance, session_namespace(user_id), selection
+            )
+    except Throttled as e:
+        return [], None, str(e), True
+    except:
+        revisions = []
+
+    options = [
+        {
+            "label": "Version {} - {}".format(
+                r["revision"],
+                datetime.datetime.fromtimestamp(r["saved_at"]).strftime(
+                    "%Y-%m-%d %H:%M"
+                ),
+            ),
+            "value": r["revision"],
+        }
+        for r in revisions[1:]  # the latest version is loaded by default
+    ]
+    return options, None, no_update, False
+
+
 @callback(Output("select-workout", "disabled"), Input("saved-workouts", "value"))
 def allow_saved_workout_selection(selection):
     """
@@ -392,6 +658,7 @@ def allow_saved_workout_selection(selection):
     Output("workout-modal", "is_open"),
     Output("workout-launch-alert", "children"),
     Output("workout-launch-alert", "is_open"),
+    Output("workout-scrubber", "max"),
     Input("launch-workout", "n_clicks"),
     Input("close-workout", "n_clicks"),
     State("workout-editor", "data"),
@@ -414,31 +681,33 @@ def workout_mode(launch, close, table):
         str: the content of workout-launch-alert, should there be an issue with launching
             the workout (e.g. workout is empty)
         bool: whether the workout-launch-alert should be displayed
+        int: the last second of the workout, the end of the workout-scrubber
     """
     trigger = ctx.triggered_id  # callback context
 
     # Reset workout data when workout is closed
     if trigger == "close-workout" and close:
-        return [], False, no_update, no_update
+        return [], False, no_update, no_update, no_update
 
     # Prevent opening of workout modal until launch button is pressed
     if not launch:
-        return no_update, no_update, no_update, no_update
+        return no_update, no_update, no_update, no_update, no_update
 
     # Handling the case where workout is empty
     if not len(table):
-        return (no_update, no_update, "Please add at least 1 interval", True)
+        return (no_update, no_update, "Please add at least 1 interval", True, no_update)
 
-    # Converts tabular workout data to data to be stored in "workout-plan"
-    plan = create_workout_plan(
+    # Converts tabular workout data to data to be stored in "workout-plan". plans are
+    # cached by workout content, so identical workouts are only compiled once
+    plan = cached_workout_plan(
         table, timestamp=START_COUNTDOWN
     )  # start first exercise after START_COUNTDOWN seconds
 
     # Display error if there are issues with the workout_plan
     if type(plan) == str:
-        return no_update, no_update, plan, True
+        return no_update, no_update, plan, True, no_update
 
-    return plan, True, no_update, no_update
+    return plan, True, no_update, no_update, plan["total_duration"]
 
 
 @callback(
@@ -449,20 +718,34 @@ def workout_mode(launch, close, table):
     Output("workout-timer", "n_intervals"),
     Output("pause-workout", "disabled"),
     Output("next-exercise", "children"),
+    Output("workout-scrubber", "value"),
     Input("start-workout", "n_clicks"),
     Input("pause-workout", "n_clicks"),
     Input("close-workout", "n_clicks"),
     Input("workout-timer", "n_intervals"),
+    Input("previous-segment", "n_clicks"),
+    Input("next-segment", "n_clicks"),
+    Input("workout-scrubber", "value"),
     State("workout-plan", "data"),
     State("workout-timer", "disabled"),
+    State("pause-workout", "disabled"),
     prevent_initial_call=True,
 )
 def operate_workout(
-    start_click, pause_click, close_workout, n_intervals, workout_plan, timer_disabled
+    start_click,
+    pause_click,
+    close_workout,
+    n_intervals,
+    previous_click,
+    next_click,
+    scrub_value,
+    workout_plan,
+    timer_disabled,
+    pause_disabled,
 ):
     """
-    Callback which operates while the workout is launched. Handles the start, pause, and close
-    buttons, the timer, and the data displayed on the workout screen
+    Callback which operates while the workout is launched. Handles the start, pause, close,
+    skip and scrub controls, the timer, and the data displayed on the workout screen
 
     Inputs:
         start_click (int): the number of times the start-workout button has been clicked
@@ -470,12 +753,17 @@ def operate_workout(
         close_workout (int): the number of times the close-workout button has been clicked
         n_intervals (int): the number of seconds elapsed on the workout timer. this value
             does not accumulate when workout-timer is disabled
+        previous_click (int): the number of times the previous-segment button has been clicked
+        next_click (int): the number of times the next-segment button has been clicked
+        scrub_value (int): the second of the workout selected on the workout-scrubber
 
     States:
         workout-plan (dict): the schema of the workout. contains the timestamp markers and
             their corresponding exercises and audio sounds. also contains metadata such as
             the total workout duration
         timer_disabled (bool): indicates whether or not the workout-timer is currently disabled
+        pause_disabled (bool): indicates whether or not the pause-workout button is disabled,
+            i.e. the workout has not started or has finished
 
     Outputs:
         bool: whether or not the workout-timer is disabled (e.g. when the pause or close button
@@ -485,9 +773,11 @@ def operate_workout(
             currently paused)
         str: the name of the audio to be played - either "bell", "beep", or "short_beep"
         int: the number of seconds elapsed on the workout timer. this value is reset when the
-            workout is closed
+            workout is closed, and set when skipping or scrubbing through the workout
         bool: whether or not the pause-workout button is disabled
         str: the name of the exercise for the next interval
+        int: the second of the workout shown on the workout-scrubber. follows the timer
+            while the workout runs
     """
 
     # Establish callback context - determines which input caused the callback to fire
@@ -503,19 +793,17 @@ def operate_workout(
             no_update,
             no_update,
             no_update,
+            no_update,
         )
 
     # Start the workout
     elif trigger == "start-workout" and start_click:
-        first_exercise = (
-            "Up next: "
-            + workout_plan[str(workout_plan["timestamp_list"][0])]["exercise"]
-        )
-        return False, "Starting workout", no_update, "bell", 0, False, first_exercise
+        first_exercise = "Up next: " + workout_plan["exercise_list"][0]
+        return False, "Starting workout", no_update, "bell", 0, False, first_exercise, 0
 
     # Close workout - reset n_intervals
     if trigger == "close-workout":
-        return True, "Workout not started", "Pause workout", "bell", 0, True, ""
+        return True, "Workout not started", "Pause workout", "bell", 0, True, "", 0
 
     # Pause workout
     if trigger == "pause-workout" and pause_click:
@@ -528,6 +816,7 @@ def operate_workout(
                 no_update,
                 no_update,
                 no_update,
+                no_update,
             )
         else:
             return (
@@ -538,21 +827,47 @@ def operate_workout(
                 no_update,
                 no_update,
                 no_update,
+                no_update,
             )
 
+    # Skip to another interval, or scrub to a given second - only once the workout has
+    # started. the timer carries on from the new position (or stays paused)
+    if (
+        trigger in ("previous-segment", "next-segment", "workout-scrubber")
+        and not pause_disabled
+    ):
+        if trigger == "workout-scrubber":
+            second = int(scrub_value or 0)
+        else:
+            step = 1 if trigger == "next-segment" else -1
+            second = seek_segment(workout_plan, n_intervals or 0, step)
+        place = locate_in_plan(workout_plan, second)
+        if place["exercise"] == "Finished":
+            disabled = True
+            second = workout_plan["total_duration"]
+        else:
+            disabled = no_update
+        return (
+            disabled,
+            place["exercise"],
+            no_update,
+            workout_plan.get(str(second), {}).get("audio", no_update),
+            second,
+            disabled,
+            place["next_exercise"],
+            second,
+        )
+
     # Update content based on timer
     # This section of code runs when n_intervals matches a timestamp in workout_plan
-    if trigger == "workout-timer" and n_intervals in workout_plan["timestamp_list"]:
-        timestamp_str = str(n_intervals)  # timestamp keys in workout_plan are strings
+    timestamp_str = str(n_intervals)  # timestamp keys in workout_plan are strings
+    if trigger == "workout-timer" and timestamp_str in workout_plan:
         current_exercise = workout_plan[timestamp_str]["exercise"]
         if current_exercise == "Finished":
             disabled = True
-            next_exercise = ""
         else:
             disabled = no_update
-            next_exercise = find_next_exercise(
-                workout_plan, n_intervals, current_exercise
-            )
+        next_exercise = locate_in_plan(workout_plan, n_intervals)["next_exercise"]
         return (
             disabled,
             current_exercise,
@@ -561,28 +876,33 @@ def operate_workout(
             n_intervals,
             disabled,
             next_exercise,
+            n_intervals,
         )
 
-    # No updates when timer does not match a timestamp in workout_plan
-    return no_update, no_update, no_update, no_update, no_update, no_update, no_update
-
-
-@callback(
-    Output("audio-player", "src"),
-    Input("trigger-audio", "data"),
-)
-def change_audio(audio):
-    """
-    Updates the audio sound based on the place in the workout (i.e. start and end with the
-        'bell' sound, use a 'beep' when changing exercises, use 'short_beep' for sub-intervals)
-
-    Inputs:
-        audio (str): the name of the audio sound to be played
+    # Keep the scrubber at the current second while the workout runs
+    if trigger == "workout-timer":
+        return (
+            no_update,
+            no_update,
+            no_update,
+            no_update,
+            no_update,
+            no_update,
+            no_update,
+            n_intervals,
+        )
 
-    Outputs:
-        str: the url of the audio file corresponding to the desired sound
-    """
-    return "/assets/{}.mp3".format(audio)
+    # No updates otherwise
+    return (
+        no_update,
+        no_update,
+        no_update,
+        no_update,
+        no_update,
+        no_update,
+        no_update,
+        no_update,
+    )
 
 
 @callback(
@@ -607,11 +927,10 @@ def progress_bar(n_intervals, workout_plan):
         int: The percent completion of the workout
         str: String representation of the percent completion
     """
-    if not n_intervals:
+    if not n_intervals or not workout_plan:
         return 0, "0% complete"
     else:
-        total_duration = workout_plan["total_duration"]
-        progress = int((n_intervals / total_duration) * 100)
+        progress = locate_in_plan(workout_plan, n_intervals)["progress"]
         return progress, "{}%".format(progress)
 
 
@@ -619,12 +938,12 @@ def progress_bar(n_intervals, workout_plan):
     Output("countdown", "children"),
     Input("workout-timer", "n_intervals"),
     State("workout-plan", "data"),
-    State("countdown", "children"),
     prevent_initial_call=True,
 )
-def count_down(n_intervals, workout_plan, current_count):
+def count_down(n_intervals, workout_plan):
     """
-    Callback which controls the interval countdown
+    Callback which controls the interval countdown. The countdown is found from the place
+        in the workout, so it is correct after skipping or scrubbing through the workout
 
     Inputs:
         n_intervals (int): the number of seconds elapsed in the workout
@@ -633,55 +952,89 @@ def count_down(n_intervals, workout_plan, current_count):
         workout-plan (dict): the schema of the workout. contains the timestamp markers and
             their corresponding exercises and audio sounds. also contains metadata such as
             the total workout duration
-        current_count (int): the value currently displayed in the countdown
 
     Outputs:
         int: the value to be displayed in the countdown
     """
 
     # If workout has not started
-    if int(n_intervals) == 0:
+    if not n_intervals or not workout_plan:
         return START_COUNTDOWN
 
-    # When new interval begins, update the countdown
-    if (
-        n_intervals in workout_plan["timestamp_list"]
-        and workout_plan[str(n_intervals)]["countdown"]  # countdown in non-zero
-    ):
-        return workout_plan[str(n_intervals)]["countdown"]
-
-    # Stop counting when countdown reaches zero
-    elif current_count == 0:
-        return no_update
-
-    # Decrease the countdown by 1 if no interval change
-    else:
-        return current_count - 1
+    return locate_in_plan(workout_plan, n_intervals)["countdown"]
 
 
 clientside_callback(
     """
-    function(n){
-        const audioElement = document.querySelector('#audio-player')
-        audioElement.autoplay=true;
-        audioElement.load();
+    function(audio, urls){
+        // Load every sound once, then replay the loaded sound on each cue
+        if (!window.workoutAudio) {
+            window.workoutAudio = {};
+            for (const name in urls) {
+                window.workoutAudio[name] = new Audio(urls[name]);
+                window.workoutAudio[name].preload = 'auto';
+            }
+        }
+        const audioElement = window.workoutAudio[audio];
+        audioElement.currentTime = 0;
+        audioElement.play().catch(() => {});
         return ''
     }
     """,
     Output("dummy-div", "children"),
     Input("trigger-audio", "data"),
+    State("audio-urls", "data"),
     prevent_initial_call=True,
 )
 """
-Clientside callback to make the audio sound
+Clientside callback to make the audio sound (i.e. start and end with the 'bell' sound, use a
+'beep' when changing exercises, use 'short_beep' for sub-intervals)
 
 Inputs:
     trigger-audio (str): the name of the audio sound to be played
 
+States:
+    audio-urls (dict): the (fingerprinted) url of each audio sound
+
 Outputs
     str: a dummy output, no purpose other than to have a complete callback
 """
 
+clientside_callback(
+    """
+    function(ts, userId){
+        if (userId) {
+            return window.dash_clientside.no_update
+        }
+        // randomUUID is only available on https (or localhost), e.g. not when the app is
+        // opened over plain http on the local network
+        if (crypto.randomUUID) {
+            return crypto.randomUUID()
+        }
+        return Array.from(
+            crypto.getRandomValues(new Uint8Array(16)),
+            (b) => b.toString(16).padStart(2, '0')
+        ).join('')
+    }
+    """,
+    Output("user-id", "data"),
+    Input("user-id", "modified_timestamp"),
+    State("user-id", "data"),
+)
+"""
+Clientside callback which creates a persistent id for the user the first time the app is
+opened in their browser. saved workouts are stored under this id
+
+Inputs:
+    user-id.modified_timestamp (int): fires when the app is loaded
+
+States:
+    user-id (str): the id of the user, if it has already been created
+
+Outputs:
+    str: the id of the user
+"""
+
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,6 @@
+// Registers the service worker which caches the app shell and assets (see utils/assets.py)
+if ("serviceWorker" in navigator) {
+    window.addEventListener("load", function () {
+        navigator.serviceWorker.register("/service-worker.js");
+    });
+}
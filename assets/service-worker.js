@@ -0,0 +1,85 @@
+// Caches the app shell and assets, so repeat visits and in-progress workouts do not
+// depend on the network. Served by utils/assets.py, which fills in the placeholders
+const VERSION = "__ASSET_VERSION__";
+const PRECACHE_URLS = __PRECACHE_URLS__;
+const CACHE_PREFIX = "workout-intervals-";
+const CACHE_NAME = CACHE_PREFIX + VERSION;
+
+// Fingerprinted urls never change, so can always be served from the cache
+function isImmutable(url) {
+    return (
+        url.pathname.startsWith("/assets-immutable/") ||
+        url.pathname.startsWith("/_dash-component-suites/") ||
+        url.origin !== self.location.origin
+    );
+}
+
+self.addEventListener("install", function (event) {
+    event.waitUntil(
+        caches.open(CACHE_NAME).then(function (cache) {
+            return cache.addAll(PRECACHE_URLS);
+        })
+    );
+    self.skipWaiting();
+});
+
+// Remove the caches of previous asset versions
+self.addEventListener("activate", function (event) {
+    event.waitUntil(
+        caches.keys().then(function (names) {
+            return Promise.all(
+                names
+                    .filter(function (name) {
+                        return name.startsWith(CACHE_PREFIX) && name !== CACHE_NAME;
+                    })
+                    .map(function (name) {
+                        return caches.delete(name);
+                    })
+            );
+        }).then(function () {
+            return self.clients.claim();
+        })
+    );
+});
+
+self.addEventListener("fetch", function (event) {
+    // Callbacks are POST requests, and are never cached
+    if (event.request.method !== "GET") {
+        return;
+    }
+    const url = new URL(event.request.url);
+
+    // Cache first for fingerprinted assets and libraries
+    if (isImmutable(url)) {
+        event.respondWith(
+            caches.match(event.request).then(function (cached) {
+                return cached || fetch(event.request).then(function (response) {
+                    if (response.ok || response.type === "opaque") {
+                        const copy = response.clone();
+                        caches.open(CACHE_NAME).then(function (cache) {
+                            cache.put(event.request, copy);
+                        });
+                    }
+                    return response;
+                });
+            })
+        );
+        return;
+    }
+
+    // Network first for the app shell (page, layout and callback definitions), falling
+    // back to the cached copy when offline
+    event.respondWith(
+        fetch(event.request).then(function (response) {
+            if (response.ok) {
+                const copy = response.clone();
+                caches.open(CACHE_NAME).then(function (cache) {
+                    cache.put(event.request, copy);
+                });
+            }
+            return response;
+        }).catch(function () {
+            return caches.match(event.request);
+        })
+    );
+});
@@ -0,0 +1,317 @@
+"""
+Library-wide analytics over the workouts saved in redis
+
+The saved workouts are streamed out of redis in chunks and flattened into columnar numpy
+arrays (one entry per interval row), so that aggregates over the whole library are computed
+with vectorised operations rather than by building a workout plan for every saved workout.
+
+In the app, users only see the report for their own workouts. The report for the whole
+library (or any one user) can be run from the command line:
+
+    python -m utils.analytics --top 10
+    python -m utils.analytics --user <user>
+"""
+import os
+import json
+import argparse
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+from utils.storage import (
+    DEFAULT_TENANT,
+    iter_library,
+    library_version_key,
+    user_namespace,
+)
+
+CHUNK_SIZE = 500
+HISTOGRAM_BINS = 10
+REPORT_CACHE_SIZE = 128
+
+_report_cache = OrderedDict()  # namespace -> (library version, report)
+_report_cache_lock = threading.Lock()  # callbacks run on several threads
+
+
+def _parse_chunk(chunk, first_workout, vocabulary, exercise_names):
+    """
+    Parses a chunk of saved workouts into columnar arrays
+
+    Inputs:
+        chunk (list): (workout_id, raw json) pairs as returned by iter_library
+        first_workout (int): the library index of the first workout in the chunk
+        vocabulary (dict): maps normalised exercise names to their interned id. updated in
+            place as new exercises are found
+        exercise_names (list): the display name for each interned id. updated in place
+
+    Outputs:
+        list: the names of the workouts which were parsed successfully
+        dict: the columns for the chunk, keyed by column name
+        int: the number of workouts which could not be parsed
+    """
+    names = []
+    workout, duration, sub_intervals, exercise = [], [], [], []
+    invalid = 0
+    for workout_id, raw in chunk:
+        try:
+            rows = [
+                (
+                    int(row["duration"]),
+                    max(int(row["sub-intervals"]), 1),
+                    str(row["exercise"]).strip(),
+                )
+                for row in json.loads(raw)
+            ]
+        except (ValueError, TypeError, KeyError):
+            invalid += 1
+            continue
+
+        index = first_workout + len(names)
+        names.append(workout_id.replace("_", " "))
+        for row_duration, row_sub_intervals, row_exercise in rows:
+            key = row_exercise.lower()
+            if key not in vocabulary:
+                vocabulary[key] = len(exercise_names)
+                exercise_names.append(row_exercise)
+            workout.append(index)
+            duration.append(row_duration)
+            sub_intervals.append(row_sub_intervals)
+            exercise.append(vocabulary[key])
+
+    columns = {
+        "workout": np.array(workout, dtype=np.int64),
+        "duration": np.array(duration, dtype=np.int64),
+        "sub_intervals": np.array(sub_intervals, dtype=np.int64),
+        "exercise": np.array(exercise, dtype=np.int64),
+    }
+    return names, columns, invalid
+
+
+def load_library_columns(redis_instance, chunk_size=CHUNK_SIZE, namespace=None):
+    """
+    Streams the saved workout library out of redis into columnar numpy arrays
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        chunk_size (int): the number of workouts fetched from redis per round trip
+        namespace (str): only load the workouts saved in this namespace (None for all)
+
+    Outputs:
+        dict: the library columns. "workout", "duration", "sub_intervals" and "exercise"
+            are arrays with one entry per interval row, "workout_names" and
+            "exercise_names" map the integer ids back to names, and "invalid" counts the
+            workouts which could not be parsed
+    """
+    vocabulary = {}
+    exercise_names = []
+    workout_names = []
+    chunks = []
+    invalid = 0
+
+    for chunk in iter_library(
+        redis_instance, batch_size=chunk_size, namespace=namespace
+    ):
+        names, columns, chunk_invalid = _parse_chunk(
+            chunk, len(workout_names), vocabulary, exercise_names
+        )
+        workout_names.extend(names)
+        chunks.append(columns)
+        invalid += chunk_invalid
+
+    library = {
+        column: (
+            np.concatenate([c[column] for c in chunks])
+            if chunks
+            else np.array([], dtype=np.int64)
+        )
+        for column in ("workout", "duration", "sub_intervals", "exercise")
+    }
+    library["workout_names"] = workout_names
+    library["exercise_names"] = exercise_names
+    library["invalid"] = invalid
+    return library
+
+
+def summarise_library(library, top=10, bins=HISTOGRAM_BINS):
+    """
+    Computes the library-wide aggregates from the columnar library data
+
+    Inputs:
+        library (dict): the columns returned by load_library_columns
+        top (int): the number of most common exercises to report
+        bins (int): the number of bins in the total duration histogram
+
+    Outputs:
+        dict: the library report
+    """
+    n_workouts = len(library["workout_names"])
+    report = {
+        "workouts": n_workouts,
+        "intervals": int(library["workout"].size),
+        "invalid": library["invalid"],
+    }
+    if not n_workouts:
+        return report
+
+    # Per-workout totals - each row's value is added into its workout's bucket
+    total_duration = np.bincount(
+        library["workout"], weights=library["duration"], minlength=n_workouts
+    )
+    total_sub_intervals = np.bincount(
+        library["workout"], weights=library["sub_intervals"], minlength=n_workouts
+    )
+    intervals = np.bincount(library["workout"], minlength=n_workouts)
+
+    # Work/sub-interval density, in cues per minute of workout
+    minutes = total_duration / 60
+    nonzero = minutes > 0
+    density = total_sub_intervals[nonzero] / minutes[nonzero]
+
+    counts, edges = np.histogram(total_duration / 60, bins=bins)
+    p10, p50, p90 = np.percentile(total_duration, [10, 50, 90])
+    report["duration"] = {
+        "min": int(total_duration.min()),
+        "p10": float(p10),
+        "median": float(p50),
+        "mean": float(total_duration.mean()),
+        "p90": float(p90),
+        "max": int(total_duration.max()),
+        "histogram": [
+            (float(edges[i]), float(edges[i + 1]), int(counts[i]))
+            for i in range(len(counts))
+        ],
+    }
+    report["intervals_per_workout"] = float(intervals.mean())
+    report["sub_intervals_per_minute"] = {
+        "mean": float(density.mean()) if density.size else 0.0,
+        "median": float(np.median(density)) if density.size else 0.0,
+    }
+
+    # Most common exercises, counted once per interval row
+    exercise_counts = np.bincount(library["exercise"])
+    most_common = np.argsort(-exercise_counts, kind="stable")[:top]
+    report["top_exercises"] = [
+        (library["exercise_names"][i], int(exercise_counts[i])) for i in most_common
+    ]
+    return report
+
+
+def library_report(redis_instance, top=10, chunk_size=CHUNK_SIZE, namespace=None):
+    """
+    Builds the library report
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        top (int): the number of most common exercises to report
+        chunk_size (int): the number of workouts fetched from redis per round trip
+        namespace (str): only report on the workouts saved in this namespace (None for all)
+
+    Outputs:
+        dict: the library report
+    """
+    library = load_library_columns(redis_instance, chunk_size, namespace=namespace)
+    return summarise_library(library, top=top)
+
+
+def cached_library_report(redis_instance, namespace):
+    """
+    Returns the report for the workouts saved in a namespace, only rebuilding it when the
+        namespace's library version has changed since the report was last built
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        namespace (str): the user's namespace
+
+    Outputs:
+        dict: the library report
+    """
+    version = redis_instance.get(library_version_key(namespace)) or b"0"
+    with _report_cache_lock:
+        cached = _report_cache.get(namespace)
+        if cached is not None and cached[0] == version:
+            _report_cache.move_to_end(namespace)
+            return cached[1]
+
+    report = library_report(redis_instance, namespace=namespace)
+    with _report_cache_lock:
+        _report_cache[namespace] = (version, report)
+        _report_cache.move_to_end(namespace)
+        if len(_report_cache) > REPORT_CACHE_SIZE:
+            _report_cache.popitem(last=False)
+    return report
+
+
+def format_report(report):
+    """
+    Formats the library report as plain text
+
+    Inputs:
+        report (dict): the library report
+
+    Outputs:
+        str: the formatted report
+    """
+    lines = [
+        "Saved workouts: {}".format(report["workouts"]),
+        "Intervals: {}".format(report["intervals"]),
+    ]
+    if report["invalid"]:
+        lines.append("Unreadable workouts: {}".format(report["invalid"]))
+    if not report["workouts"]:
+        return "\n".join(lines)
+
+    duration = report["duration"]
+    lines += [
+        "",
+        "Total duration (s): min {} / p10 {:.0f} / median {:.0f} / mean {:.0f} / "
+        "p90 {:.0f} / max {}".format(
+            duration["min"],
+            duration["p10"],
+            duration["median"],
+            duration["mean"],
+            duration["p90"],
+            duration["max"],
+        ),
+    ]
+    for low, high, count in duration["histogram"]:
+        lines.append("  {:6.1f} - {:6.1f} min: {}".format(low, high, count))
+    lines += [
+        "",
+        "Intervals per workout: {:.1f}".format(report["intervals_per_workout"]),
+        "Sub-intervals per minute: mean {:.2f} / median {:.2f}".format(
+            report["sub_intervals_per_minute"]["mean"],
+            report["sub_intervals_per_minute"]["median"],
+        ),
+        "",
+        "Most common exercises:",
+    ]
+    for exercise, count in report["top_exercises"]:
+        lines.append("  {}: {}".format(exercise, count))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import redis
+
+    parser = argparse.ArgumentParser(
+        description="Library-wide analytics over saved workouts"
+    )
+    parser.add_argument("--top", type=int, default=10, help="most common exercises")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--json", action="store_true", help="output the raw report")
+    parser.add_argument("--user", help="only report on one user's workouts")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT)
+    args = parser.parse_args()
+
+    redis_instance = redis.StrictRedis.from_url(
+        os.environ.get("REDIS_URL", "redis://127.0.0.1:6379")
+    )
+    report = library_report(
+        redis_instance,
+        top=args.top,
+        chunk_size=args.chunk_size,
+        namespace=user_namespace(args.user, tenant=args.tenant) if args.user else None,
+    )
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
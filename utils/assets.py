@@ -0,0 +1,174 @@
+"""
+Cache-friendly serving of the files in the assets folder
+
+Each asset is served from a fingerprinted url (e.g. /assets-immutable/beep.1a2b3c4d5e6f.mp3)
+which changes whenever the file does, so browsers can cache it indefinitely. Text assets are
+compressed once when the app starts, with gzip and (if installed) brotli, rather than on
+every request.
+
+Also serves the service worker, which caches the app shell and the assets so that repeat
+visits and in-progress workouts do not depend on the network.
+"""
+import os
+import gzip
+import json
+import hashlib
+import mimetypes
+
+from flask import Response, abort, request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is used on its own
+    brotli = None
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "assets")
+IMMUTABLE_PREFIX = "/assets-immutable/"
+SERVICE_WORKER = "service-worker.js"
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".json", ".svg", ".html", ".txt")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_manifest = {}
+_immutable_assets = {}  # the manifest, keyed by fingerprinted filename
+
+
+def build_asset_manifest(assets_dir=ASSETS_DIR):
+    """
+    Fingerprints and precompresses every file in the assets folder
+
+    Inputs:
+        assets_dir (str): the path of the assets folder
+
+    Outputs:
+        dict: maps each asset's name to its fingerprinted url, mimetype, etag and encoded
+            contents
+    """
+    manifest = {}
+    for name in sorted(os.listdir(assets_dir)):
+        path = os.path.join(assets_dir, name)
+        if not os.path.isfile(path) or name == SERVICE_WORKER:
+            continue
+        with open(path, "rb") as f:
+            content = f.read()
+
+        fingerprint = hashlib.sha256(content).hexdigest()[:12]
+        stem, extension = os.path.splitext(name)
+        encodings = {"identity": content}
+        if extension in COMPRESSIBLE_EXTENSIONS:
+            encodings["gzip"] = gzip.compress(content, compresslevel=9, mtime=0)
+            if brotli is not None:
+                encodings["br"] = brotli.compress(content)
+            encodings = {  # only keep encodings which are actually smaller
+                k: v for k, v in encodings.items() if len(v) <= len(content)
+            }
+
+        manifest[name] = {
+            "url": "{}{}.{}{}".format(IMMUTABLE_PREFIX, stem, fingerprint, extension),
+            "mimetype": mimetypes.guess_type(name)[0] or "application/octet-stream",
+            "etag": fingerprint,
+            "encodings": encodings,
+        }
+    return manifest
+
+
+def asset_manifest():
+    """
+    Outputs:
+        dict: the asset manifest, built the first time it is needed
+    """
+    if not _manifest:
+        _manifest.update(build_asset_manifest())
+        _immutable_assets.update(
+            {a["url"][len(IMMUTABLE_PREFIX) :]: a for a in _manifest.values()}
+        )
+    return _manifest
+
+
+def asset_url(name):
+    """
+    Inputs:
+        name (str): the name of the file in the assets folder, e.g. "style.css"
+
+    Outputs:
+        str: the fingerprinted url of the asset
+    """
+    return asset_manifest()[name]["url"]
+
+
+def asset_version():
+    """
+    Outputs:
+        str: a version which changes whenever any asset changes
+    """
+    fingerprints = "".join(a["etag"] for a in asset_manifest().values())
+    return hashlib.sha256(fingerprints.encode("utf-8")).hexdigest()[:12]
+
+
+def _choose_encoding(encodings):
+    """
+    Picks the smallest encoding of an asset which the client accepts
+    """
+    accepted = request.accept_encodings
+    for encoding in ("br", "gzip"):
+        if encoding in encodings and accepted[encoding]:
+            return encoding
+    return "identity"
+
+
+def serve_immutable_asset(filename):
+    """
+    Serves a fingerprinted asset, precompressed where possible, with long-lived cache headers
+    """
+    asset_manifest()
+    asset = _immutable_assets.get(filename)
+    if asset is None:
+        abort(404)
+
+    headers = {
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "ETag": '"{}"'.format(asset["etag"]),
+        "Vary": "Accept-Encoding",
+    }
+    if asset["etag"] in request.if_none_match:
+        return Response(status=304, headers=headers)
+
+    encoding = _choose_encoding(asset["encodings"])
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        asset["encodings"][encoding], mimetype=asset["mimetype"], headers=headers
+    )
+
+
+def serve_service_worker():
+    """
+    Serves the service worker with the current asset version and urls filled in. Served from
+        the root of the site, so that it controls every page, and never cached, so that
+        browsers pick up new versions of the assets
+    """
+    with open(os.path.join(ASSETS_DIR, SERVICE_WORKER)) as f:
+        script = f.read()
+    precache = ["/"] + [a["url"] for a in asset_manifest().values()]
+    script = script.replace("__ASSET_VERSION__", asset_version()).replace(
+        "__PRECACHE_URLS__", json.dumps(precache)
+    )
+    return Response(
+        script,
+        mimetype="application/javascript",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+def register_asset_routes(server):
+    """
+    Adds the fingerprinted asset and service worker routes to the flask server
+
+    Inputs:
+        server (flask.Flask): the server underlying the dash app
+    """
+    server.add_url_rule(
+        IMMUTABLE_PREFIX + "<path:filename>",
+        "immutable_asset",
+        serve_immutable_asset,
+    )
+    server.add_url_rule("/" + SERVICE_WORKER, "service_worker", serve_service_worker)
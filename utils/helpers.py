@@ -1,5 +1,17 @@
+import json
 import string
 import random
+import bisect
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+PLAN_CACHE_SIZE = 128
+RESTART_SEGMENT_AFTER = 2  # seconds into a segment after which "back" restarts it
+
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()  # callbacks run on several threads
 
 
 def create_sub_interval_timestamps(duration, sub_intervals):
@@ -42,12 +54,16 @@ def create_workout_plan(table, timestamp):
         dict: contains the workout data
     """
     plan = {}
+    interval_list = []  # the starting timestamp of each interval
+    exercise_list = []
     for interval in table:
         duration = int(interval["duration"])
         exercise = interval["exercise"]
         sub_intervals = int(interval["sub-intervals"])
         if sub_intervals > duration:  # error catching
             return "Please ensure no sub-intervals exceed interval duration"
+        interval_list.append(timestamp)
+        exercise_list.append(exercise)
         if sub_intervals <= 1:  # ie no sub intervals
             plan[timestamp] = {
                 "exercise": exercise,
@@ -74,34 +90,170 @@ def create_workout_plan(table, timestamp):
 
     # Add in "Finished" to plan
     plan[timestamp] = {"exercise": "Finished", "audio": "bell", "countdown": 0}
-    plan["timestamp_list"] = list(
-        plan.keys()
-    )  # additionally store timestamp keys in list
     plan["total_duration"] = timestamp
 
+    # Index of the intervals, used to find the place in the workout at any given second
+    plan["interval_list"] = interval_list + [timestamp]
+    plan["exercise_list"] = exercise_list + ["Finished"]
+    plan["next_exercise_list"] = find_next_exercises(plan["exercise_list"])
+
     return plan
 
 
-def find_next_exercise(workout_plan, n_intervals, current_exercise):
+def find_next_exercises(exercise_list):
     """
-    Determines which exercise is "up next"
+    Determines which exercise is "up next" for each interval, skipping over any following
+        intervals of the same exercise
 
     Inputs:
-        workout_plan (dict): the schema of the workout
-        n_intervals (int): the number of seconds elapsed in the workout
-        current_exercise (str): the name of the current exercise
+        exercise_list (list): the name of the exercise for each interval, ending with
+            "Finished"
 
     Outputs:
-        str: the name of the next exercise
-    """
-    timestamp_list = workout_plan["timestamp_list"]
-    i = 1
-    while i < len(timestamp_list):
-        next_exercise_timestamp = str(
-            timestamp_list[timestamp_list.index(n_intervals) + i]
-        )
-        next_exercise = workout_plan[next_exercise_timestamp]["exercise"]
-        if next_exercise != current_exercise:
-            return "Up next: " + next_exercise
+        list: the "up next" text for each interval
+    """
+    next_exercises = [""] * len(exercise_list)
+    for i in range(len(exercise_list) - 2, -1, -1):
+        if exercise_list[i + 1] != exercise_list[i] or i + 2 == len(exercise_list):
+            next_exercises[i] = "Up next: " + exercise_list[i + 1]
         else:
-            i += 1
+            next_exercises[i] = next_exercises[i + 1]
+    return next_exercises
+
+
+def locate_in_plan(workout_plan, second):
+    """
+    Finds the place in the workout at any given second, using a binary search over the
+        interval starting timestamps
+
+    Inputs:
+        workout_plan (dict): the schema of the workout
+        second (int): the number of seconds elapsed in the workout
+
+    Outputs:
+        dict: the current exercise, the remaining countdown for the interval, the "up next"
+            text, and the percent completion of the workout
+    """
+    interval_list = workout_plan["interval_list"]
+    progress = min(int((second / workout_plan["total_duration"]) * 100), 100)
+    i = bisect.bisect_right(interval_list, second) - 1
+
+    # Countdown before the first interval
+    if i < 0:
+        return {
+            "exercise": "Starting workout",
+            "countdown": interval_list[0] - second,
+            "next_exercise": "Up next: " + workout_plan["exercise_list"][0],
+            "progress": progress,
+        }
+
+    # Workout is finished
+    if i >= len(interval_list) - 1:
+        return {
+            "exercise": "Finished",
+            "countdown": 0,
+            "next_exercise": "",
+            "progress": 100,
+        }
+
+    return {
+        "exercise": workout_plan["exercise_list"][i],
+        "countdown": interval_list[i + 1] - second,
+        "next_exercise": workout_plan["next_exercise_list"][i],
+        "progress": progress,
+    }
+
+
+def seek_segment(workout_plan, second, step):
+    """
+    Finds the timestamp to jump to when skipping forwards or backwards through the intervals.
+        Going back restarts the current interval, unless it has only just started
+
+    Inputs:
+        workout_plan (dict): the schema of the workout
+        second (int): the number of seconds elapsed in the workout
+        step (int): 1 to skip to the next interval, -1 to go back
+
+    Outputs:
+        int: the timestamp to jump to
+    """
+    interval_list = workout_plan["interval_list"]
+    i = bisect.bisect_right(interval_list, second) - 1
+    if step > 0:
+        return interval_list[min(i + 1, len(interval_list) - 1)]
+    if i < 0:
+        return 0
+    if second - interval_list[i] >= RESTART_SEGMENT_AFTER or i == 0:
+        return interval_list[i]
+    return interval_list[i - 1]
+
+
+def normalise_table(table):
+    """
+    Puts the tabular workout data into a canonical form, so that identical workouts are
+        stored identically regardless of how they were edited
+
+    Inputs:
+        table (list): the tabular workout data
+
+    Outputs:
+        list: the workout data with intervals numbered in order and numeric values as ints
+    """
+    normalised = []
+    for i, interval in enumerate(table, start=1):
+        row = {"interval": i, "exercise": interval.get("exercise")}
+        for column in ("duration", "sub-intervals"):
+            try:
+                row[column] = int(interval.get(column))
+            except (TypeError, ValueError):
+                row[column] = interval.get(column)
+        normalised.append(row)
+    return normalised
+
+
+def content_hash(table):
+    """
+    Creates a hash of the workout content, from a hash of each of its rows. The interval
+        number is left out of each row's hash, as it is given by the order of the rows
+
+    Inputs:
+        table (list): the tabular workout data, as returned by normalise_table
+
+    Outputs:
+        str: the sha256 hex digest of the workout
+    """
+    digest = hashlib.sha256()
+    for row in table:
+        content = {k: v for k, v in row.items() if k != "interval"}
+        row = json.dumps(content, sort_keys=True, separators=(",", ":"))
+        digest.update(hashlib.sha256(row.encode()).digest())
+    return digest.hexdigest()
+
+
+def cached_workout_plan(table, timestamp):
+    """
+    Returns the workout plan for the tabular workout data, reusing the plan compiled for any
+        identical workout
+
+    Inputs:
+        table (list): the tabular workout data
+        timestamp (int): the starting timestamp
+
+    Outputs:
+        dict: contains the workout data (or str, if the workout is invalid)
+    """
+    table = normalise_table(table)
+    key = (content_hash(table), timestamp)
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache.move_to_end(key)
+            return plan
+
+    plan = create_workout_plan(table, timestamp)  # outside the lock, as it can be slow
+    with _plan_cache_lock:
+        _plan_cache[key] = plan
+        _plan_cache.move_to_end(key)
+        if len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+    return plan
@@ -0,0 +1,153 @@
+"""
+Rate limiting and admission control for the callbacks which read from or write to redis
+
+Each client gets a token bucket per action, keyed both by their user id and by their IP
+address (with a larger allowance, as several users can share an address). Clients which do
+not have a user id yet are only limited by IP address. Behind a reverse proxy, set
+TRUSTED_PROXIES so that the client's address is read from X-Forwarded-For (see app.py)
+rather than every request appearing to come from the proxy. Buckets are kept
+in redis so that limits apply across workers, or in process if RATE_LIMIT_STORE=memory or
+redis cannot be reached. Each worker also caps the number of storage calls in flight, so a
+burst of requests cannot tie up every thread waiting on redis.
+"""
+import os
+import time
+import threading
+
+from contextlib import contextmanager
+
+from flask import request, has_request_context
+
+from utils.storage import user_namespace
+
+# (tokens per second, burst size) for each action
+RATE_LIMITS = {
+    "save": (0.5, 5),
+    "load": (1, 10),
+}
+IP_ALLOWANCE = 5  # multiple of the per-user limits allowed per IP address
+MAX_IN_FLIGHT = int(os.environ.get("MAX_STORAGE_CALLS", 8))  # per worker
+ADMISSION_TIMEOUT = 1  # seconds to wait for a storage call to finish
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "redis")
+MAX_LOCAL_BUCKETS = 10000
+
+_TAKE_TOKEN = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens, updated = tonumber(bucket[1]), tonumber(bucket[2])
+if tokens == nil then
+    tokens, updated = burst, now
+end
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+_local_buckets = {}
+_local_lock = threading.Lock()
+_in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+
+class Throttled(Exception):
+    """
+    Raised when a request is rejected by the rate limiter or admission control. The message
+        is suitable for displaying to the user
+    """
+
+
+def _take_local_token(key, rate, burst, now):
+    """
+    In process version of the _TAKE_TOKEN script
+
+    Outputs:
+        bool: whether the request is allowed
+    """
+    with _local_lock:
+        if len(_local_buckets) > MAX_LOCAL_BUCKETS:
+            # Forget buckets which have refilled, as they are the same as new buckets
+            for k, (tokens, updated, r, b) in list(_local_buckets.items()):
+                if tokens + (now - updated) * r >= b:
+                    del _local_buckets[k]
+
+        tokens, updated, _, _ = _local_buckets.get(key, (burst, now, rate, burst))
+        tokens = min(burst, tokens + max(0, now - updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        _local_buckets[key] = (tokens, now, rate, burst)
+        return allowed
+
+
+def take_token(redis_instance, key, rate, burst):
+    """
+    Takes a token from a bucket, if one is available
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        key (str): the bucket
+        rate (float): the number of tokens added to the bucket per second
+        burst (int): the size of the bucket
+
+    Outputs:
+        bool: whether the request is allowed
+    """
+    now = time.time()
+    if RATE_LIMIT_STORE == "redis":
+        try:
+            return bool(redis_instance.eval(_TAKE_TOKEN, 1, key, rate, burst, now))
+        except Exception:
+            pass  # fall back to limiting within this worker
+    return _take_local_token(key, rate, burst, now)
+
+
+def client_keys(action, user_id):
+    """
+    Outputs:
+        list: (bucket key, allowance multiplier) for the client's IP address and then the
+            user. The user id is chosen by the client, so the IP address is checked first -
+            a client sending a new id with every request cannot get past its IP bucket, or
+            create a new user bucket for every rejected request
+    """
+    keys = []
+    if has_request_context() and request.remote_addr:
+        ip_key = "ratelimit:{ip/%s}:%s" % (request.remote_addr, action)
+        keys.append((ip_key, IP_ALLOWANCE))
+    if user_id:
+        # the browser's own id, even when WORKOUT_USER pins everyone to one namespace
+        keys.append(("ratelimit:{%s}:%s" % (user_namespace(user_id), action), 1))
+    return keys
+
+
+@contextmanager
+def admit(redis_instance, action, user_id):
+    """
+    Admits a storage call, if the client is within their rate limit and the worker is not
+        already busy with too many storage calls
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        action (str): the type of storage call, one of RATE_LIMITS
+        user_id (str): the id of the user
+
+    Raises:
+        Throttled: if the call is not admitted
+    """
+    rate, burst = RATE_LIMITS[action]
+    # Buckets are checked in order, stopping at the first which rejects the request, so a
+    # request rejected by its IP bucket does not take one of the user's tokens
+    for key, allowance in client_keys(action, user_id):
+        if not take_token(redis_instance, key, rate * allowance, burst * allowance):
+            raise Throttled("Too many requests! Please wait a moment and try again")
+
+    if not _in_flight.acquire(timeout=ADMISSION_TIMEOUT):
+        raise Throttled("The server is busy! Please wait a moment and try again")
+    try:
+        yield
+    finally:
+        _in_flight.release()
@@ -0,0 +1,352 @@
+"""
+Revision history for saved workouts
+
+Every save of a workout appends a revision to a redis list, stored alongside the user's other
+keys (so in the same cluster slot):
+
+    workouts:{<tenant>/<user>}:revisions:<workout_id>
+
+Most revisions only store the rows which were inserted, deleted or changed since the
+previous revision. Every SNAPSHOT_INTERVAL-th revision stores the full workout instead, so
+any revision is rebuilt from at most SNAPSHOT_INTERVAL entries. Each entry also stores its
+revision number, so revisions keep their numbers when older revisions are dropped.
+
+Old revisions are dropped, and the remaining revisions re-encoded, by the compaction job:
+
+    python -m utils.revisions compact --keep 50
+"""
+import os
+import json
+import time
+import argparse
+import difflib
+
+from redis.exceptions import WatchError
+
+from utils.helpers import normalise_table, content_hash
+from utils.storage import (
+    KEY_PREFIX,
+    BATCH_SIZE,
+    iter_namespaces,
+    list_workouts,
+)
+
+SNAPSHOT_INTERVAL = 10
+MAX_REVISIONS = 50
+
+
+def revisions_key(namespace, workout_id):
+    """
+    Outputs:
+        str: the key of the list of revisions of a saved workout
+    """
+    return "%s:{%s}:revisions:%s" % (KEY_PREFIX, namespace, workout_id)
+
+
+def _to_rows(table):
+    """
+    Converts normalised workout data to compact rows. The interval number is left out, as it
+        is given by the position of the row
+
+    Outputs:
+        list: [exercise, duration, sub-intervals] for each interval
+    """
+    return [[row["exercise"], row["duration"], row["sub-intervals"]] for row in table]
+
+
+def _to_table(rows):
+    """
+    Converts compact rows back to workout data, as it exists in the workout editor table
+    """
+    return [
+        {"interval": i, "exercise": row[0], "duration": row[1], "sub-intervals": row[2]}
+        for i, row in enumerate(rows, start=1)
+    ]
+
+
+def row_delta(old, new):
+    """
+    Finds the rows which were inserted, deleted or changed between two versions of a workout
+
+    Inputs:
+        old (list): the compact rows of the previous version
+        new (list): the compact rows of the new version
+
+    Outputs:
+        list: [start, end, rows] operations, each replacing old[start:end] with rows
+    """
+    matcher = difflib.SequenceMatcher(
+        a=[json.dumps(row) for row in old],
+        b=[json.dumps(row) for row in new],
+        autojunk=False,
+    )
+    return [
+        [i1, i2, new[j1:j2]]
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    ]
+
+
+def apply_delta(old, delta):
+    """
+    Applies a delta created by row_delta
+
+    Inputs:
+        old (list): the compact rows of the previous version
+        delta (list): the delta between the previous version and the new version
+
+    Outputs:
+        list: the compact rows of the new version
+    """
+    rows = []
+    position = 0
+    for start, end, replacement in delta:
+        rows.extend(old[position:start])
+        rows.extend(replacement)
+        position = end
+    rows.extend(old[position:])
+    return rows
+
+
+def _rebuild(entries):
+    """
+    Rebuilds a revision from the entries between the preceding snapshot and the revision
+
+    Inputs:
+        entries (list): the decoded revision entries, starting with a snapshot
+
+    Outputs:
+        list: the compact rows of the last revision in entries
+    """
+    rows = entries[0]["snapshot"]
+    for entry in entries[1:]:
+        rows = apply_delta(rows, entry["delta"])
+    return rows
+
+
+def _read_revision(redis_instance, key, index):
+    """
+    Reads the entries needed to rebuild a revision
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection (or pipeline in immediate mode)
+        key (str): the key of the list of revisions
+        index (int): the position of the revision in the list
+
+    Outputs:
+        list: the decoded revision entries
+    """
+    start = index - index % SNAPSHOT_INTERVAL
+    return [json.loads(e) for e in redis_instance.lrange(key, start, index)]
+
+
+def _revision_number(entry, index):
+    """
+    Outputs:
+        int: the revision number of an entry. Entries recorded before revision numbers were
+            stored have never been compacted, so are numbered by their position
+    """
+    return entry.get("revision", index + 1)
+
+
+def _encode(history):
+    """
+    Encodes a list of revisions as entries, with a snapshot every SNAPSHOT_INTERVAL
+        revisions and deltas in between
+
+    Inputs:
+        history (list): (rows, metadata) pairs for each revision, oldest first
+
+    Outputs:
+        list: the json revision entries
+    """
+    entries = []
+    previous = None
+    for i, (rows, metadata) in enumerate(history):
+        entry = dict(metadata)
+        if i % SNAPSHOT_INTERVAL == 0:
+            entry["snapshot"] = rows
+        else:
+            entry["delta"] = row_delta(previous, rows)
+        entries.append(json.dumps(entry))
+        previous = rows
+    return entries
+
+
+def record_revision(redis_instance, namespace, workout_id, data):
+    """
+    Records a new revision of a saved workout, unless it is identical to the latest revision
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        namespace (str): the user's namespace
+        workout_id (str): the id of the workout
+        data (list): the workout data as it exists in the workout editor table
+
+    Outputs:
+        int: the number of the latest revision
+    """
+    table = normalise_table(data)
+    rows = _to_rows(table)
+    metadata = {"hash": content_hash(table), "saved_at": int(time.time())}
+    key = revisions_key(namespace, workout_id)
+
+    with redis_instance.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                length = pipe.llen(key)
+                revision = 1
+                if length:
+                    entries = _read_revision(pipe, key, length - 1)
+                    latest = _revision_number(entries[-1], length - 1)
+                    if entries[-1]["hash"] == metadata["hash"]:
+                        return latest  # workout is unchanged
+                    previous = _rebuild(entries)
+                    revision = latest + 1
+
+                entry = dict(metadata, revision=revision)
+                if length % SNAPSHOT_INTERVAL == 0:
+                    entry["snapshot"] = rows
+                else:
+                    entry["delta"] = row_delta(previous, rows)
+
+                pipe.multi()
+                pipe.rpush(key, json.dumps(entry))
+                pipe.execute()
+                return revision
+            except WatchError:
+                continue  # revision saved concurrently, retry against it
+
+
+def list_revisions(redis_instance, namespace, workout_id):
+    """
+    Lists the revisions of a saved workout
+
+    Outputs:
+        list: a dict of the revision number, save time and content hash of each revision,
+            newest first
+    """
+    entries = redis_instance.lrange(revisions_key(namespace, workout_id), 0, -1)
+    revisions = []
+    for i, entry in enumerate(entries):
+        entry = json.loads(entry)
+        revisions.append(
+            {
+                "revision": _revision_number(entry, i),
+                "saved_at": entry["saved_at"],
+                "hash": entry["hash"],
+            }
+        )
+    return revisions[::-1]
+
+
+def load_revision(redis_instance, namespace, workout_id, revision):
+    """
+    Rebuilds a revision of a saved workout
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        namespace (str): the user's namespace
+        workout_id (str): the id of the workout
+        revision (int): the revision number, starting at 1
+
+    Outputs:
+        list: the workout data, or None if the revision does not exist (or was dropped)
+    """
+    key = revisions_key(namespace, workout_id)
+    first = redis_instance.lindex(key, 0)
+    if first is None:
+        return None
+    # Revision numbers are consecutive, starting from the oldest revision kept
+    index = revision - _revision_number(json.loads(first), 0)
+    if index < 0:
+        return None
+    entries = _read_revision(redis_instance, key, index)
+    if (
+        len(entries) != index % SNAPSHOT_INTERVAL + 1
+        or _revision_number(entries[-1], index) != revision
+    ):
+        return None  # revision does not exist, or revisions were compacted meanwhile
+    return _to_table(_rebuild(entries))
+
+
+def compact_revisions(redis_instance, namespace, workout_id, keep=MAX_REVISIONS):
+    """
+    Drops all but the latest revisions of a saved workout, re-encoding the remaining
+        revisions so the oldest is a snapshot. The remaining revisions keep their numbers
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        namespace (str): the user's namespace
+        workout_id (str): the id of the workout
+        keep (int): the number of revisions to keep, at least 1
+
+    Outputs:
+        int: the number of revisions dropped
+    """
+    if keep < 1:
+        raise ValueError("keep must be at least 1, got {}".format(keep))
+    key = revisions_key(namespace, workout_id)
+    with redis_instance.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            entries = [json.loads(e) for e in pipe.lrange(key, 0, -1)]
+            if len(entries) <= keep:
+                return 0
+
+            history = []
+            rows = None
+            for i, entry in enumerate(entries):
+                if "snapshot" in entry:
+                    rows = entry["snapshot"]
+                else:
+                    rows = apply_delta(rows, entry["delta"])
+                metadata = {
+                    "hash": entry["hash"],
+                    "saved_at": entry["saved_at"],
+                    "revision": _revision_number(entry, i),
+                }
+                history.append((rows, metadata))
+
+            pipe.multi()
+            pipe.delete(key)
+            pipe.rpush(key, *_encode(history[-keep:]))
+            pipe.execute()
+            return len(entries) - keep
+        except WatchError:
+            return 0  # revision saved concurrently, compact on the next run
+
+
+def compact_all(redis_instance, keep=MAX_REVISIONS, batch_size=BATCH_SIZE):
+    """
+    Runs compact_revisions for every saved workout
+
+    Outputs:
+        int: the number of revisions dropped
+    """
+    dropped = 0
+    for namespace in iter_namespaces(redis_instance, batch_size):
+        for workout_id in list_workouts(redis_instance, namespace):
+            dropped += compact_revisions(
+                redis_instance, namespace, workout_id, keep=keep
+            )
+    return dropped
+
+
+if __name__ == "__main__":
+    import redis
+
+    parser = argparse.ArgumentParser(description="Manage saved workout revisions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compact = subparsers.add_parser("compact", help="drop old workout revisions")
+    compact.add_argument("--keep", type=int, default=MAX_REVISIONS)
+    args = parser.parse_args()
+    if args.keep < 1:
+        parser.error("--keep must be at least 1")
+
+    redis_instance = redis.StrictRedis.from_url(
+        os.environ.get("REDIS_URL", "redis://127.0.0.1:6379")
+    )
+    dropped = compact_all(redis_instance, keep=args.keep)
+    print("Dropped {} old revisions".format(dropped))
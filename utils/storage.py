@@ -0,0 +1,437 @@
+"""
+Redis storage for saved workouts
+
+Workouts are stored per user, one key per workout plus a small per-user index:
+
+    workouts:{<tenant>/<user>}:index                 set of the user's workout ids
+    workouts:{<tenant>/<user>}:workout:<workout_id>  the content hash of the workout
+    workouts:{<tenant>/<user>}:version               incremented whenever a workout changes
+
+The namespace is wrapped in a redis cluster hash tag, so all of a user's keys live in the
+same slot (and can be written in one transaction) while different users are spread across
+the cluster.
+
+The workout data itself is stored once per distinct workout, under the hash of its
+normalised content, along with the number of saved workouts referencing it:
+
+    workouts:body:<content_hash>                     hash of "data" (json) and "refs"
+
+Bodies are deleted when their last reference is removed. Reference counts which have
+drifted (e.g. a save interrupted part way through) are repaired by the garbage collector.
+
+Workouts still in the legacy single "saved_workouts" hash (which was shared by everyone)
+remain visible to every user, read-only, until they are migrated. A user who saves a
+workout under a legacy name saves their own copy, which takes precedence.
+
+The legacy hash can be split into a namespace, and unreferenced
+bodies collected, from the command line:
+
+    python -m utils.storage migrate --user <user>
+    python -m utils.storage gc
+"""
+import os
+import re
+import json
+import argparse
+
+from redis.exceptions import WatchError
+
+from utils.helpers import normalise_table, content_hash
+
+LEGACY_KEY = "saved_workouts"
+KEY_PREFIX = "workouts"
+DEFAULT_TENANT = os.environ.get("WORKOUT_TENANT", "default")
+PINNED_USER = os.environ.get("WORKOUT_USER")  # single-user deployments
+ANONYMOUS_USER = "anonymous"
+BATCH_SIZE = 500
+
+# Adds a reference to a body, creating it if needed
+_ACQUIRE_BODY = """
+redis.call('HSETNX', KEYS[1], 'data', ARGV[1])
+return redis.call('HINCRBY', KEYS[1], 'refs', 1)
+"""
+
+# Removes a reference to a body, deleting it when no references remain
+_RELEASE_BODY = """
+local refs = redis.call('HINCRBY', KEYS[1], 'refs', -1)
+if refs <= 0 then
+    redis.call('DEL', KEYS[1])
+end
+return refs
+"""
+
+# Sets a body's reference count, provided it has not changed since it was read. A count of
+# zero deletes the body
+_RESET_BODY_REFS = """
+if redis.call('HGET', KEYS[1], 'refs') ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '0' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('HSET', KEYS[1], 'refs', ARGV[2])
+end
+return 1
+"""
+
+_unsafe_characters = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def user_namespace(user_id, tenant=DEFAULT_TENANT):
+    """
+    Creates the storage namespace for a user
+
+    Inputs:
+        user_id (str): the id of the user
+        tenant (str): the tenant the user belongs to
+
+    Outputs:
+        str: the namespace, safe to use inside a redis hash tag
+    """
+    return "{}/{}".format(
+        _unsafe_characters.sub("", tenant)[:64],
+        _unsafe_characters.sub("", user_id)[:64],
+    )
+
+
+def session_namespace(user_id):
+    """
+    Creates the storage namespace for an app session. All sessions share one namespace if
+        the WORKOUT_USER environment variable is set
+
+    Inputs:
+        user_id (str): the id stored in the user's browser, if it has been created yet
+
+    Outputs:
+        str: the namespace
+    """
+    return user_namespace(PINNED_USER or user_id or ANONYMOUS_USER)
+
+
+def index_key(namespace):
+    """
+    Outputs:
+        str: the key of the set of workout ids saved in the namespace
+    """
+    return "%s:{%s}:index" % (KEY_PREFIX, namespace)
+
+
+def workout_key(namespace, workout_id):
+    """
+    Outputs:
+        str: the key of a saved workout
+    """
+    return "%s:{%s}:workout:%s" % (KEY_PREFIX, namespace, workout_id)
+
+
+def library_version_key(namespace):
+    """
+    Outputs:
+        str: the key of the counter which changes whenever a namespace's workouts change
+    """
+    return "%s:{%s}:version" % (KEY_PREFIX, namespace)
+
+
+def body_key(workout_hash):
+    """
+    Outputs:
+        str: the key of the workout data with the given content hash
+    """
+    return "%s:body:%s" % (KEY_PREFIX, workout_hash)
+
+
+def _read_bodies(redis_instance, references):
+    """
+    Resolves the values of workout keys to the raw workout data
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        references (list): the values of workout keys - content hashes, or the workout json
+            for workouts saved before bodies were deduplicated
+
+    Outputs:
+        list: the raw json of each workout (None where the body is missing)
+    """
+    hashes = list({r for r in references if r is not None and not r.startswith(b"[")})
+    pipe = redis_instance.pipeline(transaction=False)
+    for workout_hash in hashes:
+        pipe.hget(body_key(workout_hash.decode("utf-8")), "data")
+    bodies = dict(zip(hashes, pipe.execute())) if hashes else {}
+    return [
+        bodies.get(r) if r is not None and not r.startswith(b"[") else r
+        for r in references
+    ]
+
+
+def save_workout(redis_instance, namespace, workout_id, data, overwrite=True):
+    """
+    Saves a workout, and adds it to the namespace's index. The workout data is only stored
+        if an identical workout has not already been saved. The namespace's library version
+        is incremented if the workout changed
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        namespace (str): the user's namespace
+        workout_id (str): the id of the workout
+        data (list): the workout data as it exists in the workout editor table
+        overwrite (bool): whether to replace a different workout saved under the same name
+
+    Outputs:
+        str: the content hash of the workout, or None if a different workout is already
+            saved under the name and overwrite is False
+    """
+    data = normalise_table(data)
+    workout_hash = content_hash(data)
+    key = workout_key(namespace, workout_id)
+    previous = redis_instance.get(key)
+    if previous is not None and previous.decode("utf-8") == workout_hash:
+        return workout_hash  # workout is unchanged
+    if previous is not None and not overwrite:
+        return None
+
+    # Reference the new body before pointing the name at it, so it cannot be collected
+    redis_instance.eval(_ACQUIRE_BODY, 1, body_key(workout_hash), json.dumps(data))
+
+    # Swap the name over to the new body. The name is watched, so if another save changes
+    # it first the swap is retried against that save's body, and each previous body is only
+    # released by the save which replaced it
+    with redis_instance.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                previous = pipe.get(key)
+                if previous is not None and (
+                    previous.decode("utf-8") == workout_hash or not overwrite
+                ):
+                    # saved concurrently - give back the reference taken above
+                    pipe.unwatch()
+                    redis_instance.eval(_RELEASE_BODY, 1, body_key(workout_hash))
+                    return workout_hash if overwrite else None
+                pipe.multi()
+                pipe.set(key, workout_hash)
+                pipe.sadd(index_key(namespace), workout_id)
+                pipe.incr(library_version_key(namespace))
+                pipe.execute()
+                break
+            except WatchError:
+                continue
+
+    if previous is not None and not previous.startswith(b"["):
+        redis_instance.eval(_RELEASE_BODY, 1, body_key(previous.decode("utf-8")))
+    return workout_hash
+
+
+def load_workout(redis_instance, namespace, workout_id):
+    """
+    Loads a saved workout
+
+    Outputs:
+        list: the workout data, or None if the workout does not exist
+    """
+    reference = redis_instance.get(workout_key(namespace, workout_id))
+    if reference is None:  # fall back to the shared legacy workouts
+        raw = redis_instance.hget(LEGACY_KEY, workout_id)
+    else:
+        raw = _read_bodies(redis_instance, [reference])[0]
+    return json.loads(raw) if raw is not None else None
+
+
+def list_workouts(redis_instance, namespace):
+    """
+    Lists the ids of the workouts saved in a namespace
+
+    Outputs:
+        list: the sorted workout ids
+    """
+    workout_ids = redis_instance.smembers(index_key(namespace))
+    return sorted(w.decode("utf-8") for w in workout_ids)
+
+
+def list_available_workouts(redis_instance, namespace):
+    """
+    Lists the ids of the workouts a user can load - those saved in their namespace, and
+        those not yet migrated out of the legacy hash
+
+    Outputs:
+        list: the sorted workout ids
+    """
+    pipe = redis_instance.pipeline(transaction=False)
+    pipe.smembers(index_key(namespace))
+    pipe.hkeys(LEGACY_KEY)
+    own, legacy = pipe.execute()
+    return sorted({w.decode("utf-8") for w in set(own) | set(legacy)})
+
+
+def iter_namespaces(redis_instance, batch_size):
+    """
+    Outputs:
+        generator: yields every namespace with saved workouts
+    """
+    pattern = "%s:{*}:index" % KEY_PREFIX
+    for key in redis_instance.scan_iter(match=pattern, count=batch_size):
+        yield key.decode("utf-8")[len(KEY_PREFIX) + 2 : -len("}:index")]
+
+
+def iter_library(redis_instance, batch_size=BATCH_SIZE, namespace=None):
+    """
+    Streams saved workouts in batches - either every saved workout, across all namespaces
+        and including workouts not yet migrated out of the legacy hash, or only the workouts
+        saved in one namespace
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        batch_size (int): the (approximate) number of workouts per batch
+        namespace (str): the namespace to stream, or None for the whole library
+
+    Outputs:
+        generator: yields lists of (workout_id, raw json) pairs
+    """
+    if namespace is not None:
+        namespaces = [namespace]
+    else:
+        namespaces = iter_namespaces(redis_instance, batch_size)
+        batch = []
+        for workout_id, raw in redis_instance.hscan_iter(LEGACY_KEY, count=batch_size):
+            batch.append((workout_id.decode("utf-8"), raw))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    for namespace in namespaces:
+        workout_ids = list_workouts(redis_instance, namespace)
+        for i in range(0, len(workout_ids), batch_size):
+            ids = workout_ids[i : i + batch_size]
+            references = redis_instance.mget([workout_key(namespace, w) for w in ids])
+            values = _read_bodies(redis_instance, references)
+            yield [(w, raw) for w, raw in zip(ids, values) if raw is not None]
+
+
+def migrate_legacy_workouts(redis_instance, namespace, batch_size=BATCH_SIZE):
+    """
+    Moves the workouts in the legacy "saved_workouts" hash into a namespace, in batches.
+        Each workout is removed from the legacy hash once it has been copied, so the
+        migration can be safely interrupted and re-run. Workouts whose name is already
+        saved (with different content) in the namespace, or which cannot be read, are left
+        in the legacy hash and reported. The namespace's library version is incremented for
+        each workout moved
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        namespace (str): the namespace to move the workouts into
+        batch_size (int): the number of workouts moved per round trip
+
+    Outputs:
+        dict: the number of workouts "migrated", and the names of the workouts skipped
+            because of a "conflict" or because they are "invalid"
+    """
+    result = {"migrated": 0, "conflict": [], "invalid": []}
+    cursor = 0
+    while True:
+        cursor, batch = redis_instance.hscan(LEGACY_KEY, cursor, count=batch_size)
+        moved = []
+        for workout_id, raw in batch.items():
+            name = workout_id.decode("utf-8")
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                data = None
+            if not isinstance(data, list) or not all(isinstance(r, dict) for r in data):
+                result["invalid"].append(name)
+                continue
+            if save_workout(redis_instance, namespace, name, data, overwrite=False):
+                moved.append(workout_id)
+            else:
+                result["conflict"].append(name)
+        if moved:
+            redis_instance.hdel(LEGACY_KEY, *moved)
+            result["migrated"] += len(moved)
+        if cursor == 0:  # an empty page does not mean the scan is finished
+            return result
+
+
+def collect_garbage(redis_instance, batch_size=BATCH_SIZE):
+    """
+    Mark and sweep garbage collection of workout bodies. Counts the references to each
+        body across all namespaces, repairs reference counts which have drifted, and deletes
+        bodies which are no longer referenced. Bodies whose reference count changes while
+        the collection is running (i.e. by a concurrent save) are left untouched
+
+    Inputs:
+        redis_instance (redis.Redis): the redis connection
+        batch_size (int): the number of keys read per round trip
+
+    Outputs:
+        int: the number of bodies deleted
+    """
+    # Snapshot the reference counts of every body before marking
+    recorded = {}
+    body_keys = redis_instance.scan_iter(match=body_key("*"), count=batch_size)
+    for key in body_keys:
+        recorded[key] = redis_instance.hget(key, "refs")
+
+    # Mark - count the references held by every namespace
+    marked = {}
+    for namespace in iter_namespaces(redis_instance, batch_size):
+        workout_ids = list_workouts(redis_instance, namespace)
+        for i in range(0, len(workout_ids), batch_size):
+            ids = workout_ids[i : i + batch_size]
+            for reference in redis_instance.mget(
+                [workout_key(namespace, w) for w in ids]
+            ):
+                if reference is not None and not reference.startswith(b"["):
+                    reference = body_key(reference.decode("utf-8")).encode("utf-8")
+                    marked[reference] = marked.get(reference, 0) + 1
+
+    # Sweep - correct reference counts, deleting unreferenced bodies
+    deleted = 0
+    for key, refs in recorded.items():
+        count = marked.get(key, 0)
+        if refs is not None and int(refs) == count:
+            continue
+        changed = redis_instance.eval(
+            _RESET_BODY_REFS, 1, key, refs if refs is not None else "", count
+        )
+        if changed and not count:
+            deleted += 1
+    return deleted
+
+
+if __name__ == "__main__":
+    import redis
+
+    parser = argparse.ArgumentParser(description="Manage saved workout storage")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser(
+        "migrate", help="split the legacy saved_workouts hash into a user namespace"
+    )
+    migrate.add_argument("--user", required=True, help="the user to migrate into")
+    migrate.add_argument("--tenant", default=DEFAULT_TENANT)
+    migrate.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    gc = subparsers.add_parser("gc", help="delete unreferenced workout bodies")
+    gc.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    redis_instance = redis.StrictRedis.from_url(
+        os.environ.get("REDIS_URL", "redis://127.0.0.1:6379")
+    )
+    if args.command == "migrate":
+        namespace = user_namespace(args.user, tenant=args.tenant)
+        result = migrate_legacy_workouts(
+            redis_instance, namespace, batch_size=args.batch_size
+        )
+        print("Migrated {} workouts into {}".format(result["migrated"], namespace))
+        for reason in ("conflict", "invalid"):
+            if result[reason]:
+                print(
+                    "Left {} workouts in {} ({}): {}".format(
+                        len(result[reason]),
+                        LEGACY_KEY,
+                        "name already saved" if reason == "conflict" else "unreadable",
+                        ", ".join(result[reason]),
+                    )
+                )
+    else:
+        count = collect_garbage(redis_instance, batch_size=args.batch_size)
+        print("Deleted {} unreferenced workout bodies".format(count))